@@ -0,0 +1,61 @@
+# Raw encodings of the Ivy Bridge core events used by these scripts,
+# so translating them doesn't require running ocperf.py. These are
+# from Intel's Ivy Bridge core event list, which is also what
+# ocperf.py uses.
+
+# CPU family and models this table applies to.
+MODELS = {(0x06, 0x3a), (0x06, 0x3e)}
+
+# Map from event name to (event code, umask, cmask).
+EVENTS = {
+    "CPU_CLK_UNHALTED.THREAD": (0x3c, 0x00, 0),
+    "CYCLE_ACTIVITY.CYCLES_NO_EXECUTE": (0xa3, 0x04, 4),
+    "CYCLE_ACTIVITY.STALLS_L1D_MISS": (0xa3, 0x0c, 12),
+    "CYCLE_ACTIVITY.STALLS_L2_MISS": (0xa3, 0x05, 5),
+    "CYCLE_ACTIVITY.STALLS_MEM_ANY": (0xa3, 0x06, 6),
+    "DTLB_LOAD_MISSES.STLB_HIT": (0x5f, 0x04, 0),
+    "DTLB_LOAD_MISSES.WALK_DURATION": (0x08, 0x84, 0),
+    "IDQ.ALL_DSB_CYCLES_4_UOPS": (0x79, 0x18, 4),
+    "IDQ.ALL_DSB_CYCLES_ANY_UOPS": (0x79, 0x18, 1),
+    "IDQ.ALL_MITE_CYCLES_4_UOPS": (0x79, 0x24, 4),
+    "IDQ.ALL_MITE_CYCLES_ANY_UOPS": (0x79, 0x24, 1),
+    "IDQ_UOPS_NOT_DELIVERED.CORE": (0x9c, 0x01, 0),
+    "INT_MISC.RECOVERY_CYCLES": (0x0d, 0x03, 1),
+    "L1D_PEND_MISS.FB_FULL": (0x48, 0x02, 0),
+    "L1D_PEND_MISS.PENDING": (0x48, 0x01, 0),
+    "LD_BLOCKS.NO_SR": (0x03, 0x08, 0),
+    "LD_BLOCKS.STORE_FORWARD": (0x03, 0x02, 0),
+    "LD_BLOCKS_PARTIAL.ADDRESS_ALIAS": (0x07, 0x01, 0),
+    "LSD.CYCLES_4_UOPS": (0xa8, 0x01, 4),
+    "LSD.CYCLES_ACTIVE": (0xa8, 0x01, 1),
+    "MEM_LOAD_UOPS_RETIRED.HIT_LFB": (0xd1, 0x40, 0),
+    "MEM_LOAD_UOPS_RETIRED.L1_MISS": (0xd1, 0x08, 0),
+    "MEM_LOAD_UOPS_RETIRED.LLC_HIT": (0xd1, 0x04, 0),
+    "MEM_LOAD_UOPS_RETIRED.LLC_MISS": (0xd1, 0x20, 0),
+    "MEM_UOPS_RETIRED.ALL_STORES": (0xd0, 0x82, 0),
+    "MEM_UOPS_RETIRED.LOCK_LOADS": (0xd0, 0x21, 0),
+    "OFFCORE_REQUESTS_OUTSTANDING.CYCLES_WITH_DEMAND_DATA_RD": (0x60, 0x01, 1),
+    "OFFCORE_REQUESTS_OUTSTANDING.CYCLES_WITH_DEMAND_RFO": (0x60, 0x04, 1),
+    "OFFCORE_REQUESTS_OUTSTANDING.DEMAND_DATA_RD": (0x60, 0x01, 0),
+    "RESOURCE_STALLS.SB": (0xa2, 0x08, 0),
+    "RS_EVENTS.EMPTY_CYCLES": (0x5e, 0x01, 0),
+    "UOPS_EXECUTED.THREAD": (0xb1, 0x01, 0),
+    "UOPS_ISSUED.ANY": (0x0e, 0x01, 0),
+    "UOPS_RETIRED.RETIRE_SLOTS": (0xc2, 0x02, 0),
+}
+
+def lookup(name):
+    """Return the raw perf event string for ocperf event name, which
+    may have ":cmask=N" modifiers, or None if name isn't known."""
+    base, *mods = name.split(":")
+    if base not in EVENTS:
+        return None
+    event, umask, cmask = EVENTS[base]
+    for mod in mods:
+        key, _, val = mod.partition("=")
+        if key != "cmask":
+            return None
+        cmask = int(val, 0)
+    if cmask:
+        return "cpu/event=0x%02x,umask=0x%02x,cmask=%d/" % (event, umask, cmask)
+    return "cpu/event=0x%02x,umask=0x%02x/" % (event, umask)
@@ -0,0 +1,483 @@
+# Helpers shared by the PMU counter scripts in this directory.
+
+import os
+import csv
+import re
+import sys
+import shlex
+import errno
+import ctypes
+import signal
+import struct
+import argparse
+import platform
+import subprocess
+import multiprocessing
+import concurrent.futures
+
+import _ivb_events
+
+def arg_parser(description):
+    """Return an ArgumentParser for the flags common to the counter
+    scripts. Scripts may add their own flags before calling
+    parse_args."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("-r", "--repeat", type=int, default=1, metavar="N",
+                        help="run the command N times and average the counts")
+    parser.add_argument("--sweep", metavar="FILE",
+                        help="measure each command in FILE, one per line")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="with --sweep, measure up to N commands at once, "
+                        "each pinned to its own core (0 means one per core)")
+    parser.add_argument("cmd", nargs=argparse.REMAINDER,
+                        help="command to measure")
+    return parser
+
+def parse_args(parser):
+    """Parse the command line using parser from arg_parser."""
+    args = parser.parse_args()
+    # REMAINDER keeps a "--" separating the command from our flags.
+    if args.cmd[:1] == ["--"]:
+        args.cmd = args.cmd[1:]
+    if args.sweep is None and not args.cmd:
+        parser.error("missing command")
+    if args.sweep is not None and args.cmd:
+        parser.error("--sweep and a command are mutually exclusive")
+    return args
+
+def sweep(measure, args):
+    """Call measure(cmd) for each command given by args and write the
+    results to stdout. measure returns its results as a string.
+
+    With --sweep, each command's results are written after all
+    commands are done, in the order of the sweep file, under a
+    "==> cmd <==" header. The commands' own output goes to stderr so
+    it doesn't mix with the results. With --jobs, commands run
+    concurrently in worker processes that are each pinned to one
+    hardware thread of a different physical core, so they don't share
+    a core's pipeline, L1, L2, or counters. They do still share the
+    LLC and memory bandwidth, which can skew memory-bound results.
+    """
+    if args.sweep is None:
+        sys.stdout.write(measure(args.cmd))
+        return
+
+    with open(args.sweep) as f:
+        cmds = [shlex.split(line) for line in f
+                if line.strip() and not line.lstrip().startswith("#")]
+    cpus = _one_cpu_per_core(os.sched_getaffinity(0))
+    jobs = min(args.jobs or len(cpus), len(cpus), len(cmds))
+    if jobs <= 1:
+        results = [_try_measure(measure, cmd) for cmd in cmds]
+    else:
+        mpctx = multiprocessing.get_context()
+        cpuq = mpctx.Queue()
+        for cpu in cpus[:jobs]:
+            cpuq.put(cpu)
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, mp_context=mpctx,
+                initializer=_pin_worker, initargs=(cpuq,)) as ex:
+            results = list(ex.map(_try_measure, [measure] * len(cmds), cmds))
+
+    status = 0
+    for cmd, (res, out) in zip(cmds, results):
+        sys.stdout.write("==> %s <==\n" % shlex.join(cmd))
+        sys.stdout.write(out)
+        if res:
+            print("%s: exit status %d" % (shlex.join(cmd), res), file=sys.stderr)
+            status = status or res
+    sys.exit(status)
+
+def _one_cpu_per_core(cpus):
+    # Return the lowest-numbered CPU in cpus from each physical core.
+    # Hyperthread siblings share a core's issue slots and caches, so
+    # workloads on them would perturb each other's counts.
+    res, taken = [], set()
+    for cpu in sorted(cpus):
+        if cpu in taken:
+            continue
+        res.append(cpu)
+        path = "/sys/devices/system/cpu/cpu%d/topology/thread_siblings_list" % cpu
+        try:
+            with open(path) as f:
+                taken.update(_parse_cpu_list(f.read()))
+        except OSError:
+            pass
+    return res
+
+def _parse_cpu_list(s):
+    # Parse a kernel CPU list like "0-3,8,10-11".
+    cpus = set()
+    for r in s.strip().split(","):
+        lo, _, hi = r.partition("-")
+        cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+def _pin_worker(cpuq):
+    # Each worker process takes one CPU for its lifetime.
+    os.sched_setaffinity(0, {cpuq.get()})
+
+def _try_measure(measure, cmd):
+    # Return (exit status, output). gather exits if cmd fails and
+    # perf_event_open or a parse can raise, but neither should stop
+    # the rest of a sweep.
+    #
+    # Point our stdout at stderr while cmd runs. cmd and perf stat
+    # inherit it, and measure returns its results rather than writing
+    # them.
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        return 0, measure(cmd)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1, ""
+    except Exception as e:
+        print("%s: %s" % (shlex.join(cmd), e), file=sys.stderr)
+        return 1, ""
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.close(stdout)
+
+def warn(cmd, msg):
+    """Print warning msg about measuring cmd to stderr."""
+    print("%s: warning: %s" % (shlex.join(cmd), msg), file=sys.stderr)
+
+def gather(groups, cmd, anchor=None, repeat=1):
+    """Run cmd and return a map from event name to count. If repeat >
+    1, cmd is run repeat times and the counts are averaged over the
+    runs.
+
+    groups is a list of event groups, each a list of event names. The
+    PMU always schedules the events in a group together, so they're
+    measured over the same window even when the kernel has to
+    multiplex groups. If anchor is not None, it must appear in every
+    group. Each group's counts are then normalized to the group's own
+    anchor count, so the ratio of any event to the anchor reflects
+    only the window in which that event's group was running.
+
+    Counters are opened directly with perf_event_open. If that fails,
+    this falls back to running cmd under perf stat.
+    """
+    raw = translate([counter for group in groups for counter in group])
+    rawGroups = [[raw[c] for c in group] for group in groups]
+    try:
+        counts = _count_perf_event_open(rawGroups, cmd, repeat)
+    except OSError as e:
+        warn(cmd, "perf_event_open failed (%s); falling back to perf stat" % e)
+        counts = _count_perf_stat(groups, raw, cmd, repeat)
+
+    gcounts = []
+    for group in groups:
+        gcounts.append(counts[:len(group)])
+        counts = counts[len(group):]
+
+    # Use the mean of the anchor's per-group estimates as the
+    # reference and scale each group to it. Groups that never ran
+    # have an anchor count of 0 and say nothing about the reference.
+    if anchor is not None:
+        anchors = [c[g.index(anchor)] for g, c in zip(groups, gcounts)]
+        anchors = [a for a in anchors if a != 0]
+        ref = sum(anchors) / len(anchors) if anchors else 0
+    cmap = {}
+    for group, counts in zip(groups, gcounts):
+        if anchor is not None:
+            a = counts[group.index(anchor)]
+            if a != 0:
+                counts = [c * ref / a for c in counts]
+        cmap.update(zip(group, counts))
+    if anchor is not None:
+        cmap[anchor] = ref
+
+    return cmap
+
+def _count_perf_stat(groups, raw, cmd, repeat):
+    # Run cmd under perf stat and return the counts of the events in
+    # groups, in order. raw maps event names to raw perf events.
+    #
+    # Give each counter a unique name= so we can match perf's output
+    # rows back to counters by name. Otherwise the names are perf's
+    # spelling of the raw events, which we couldn't reliably map back
+    # to counters.
+    names = []
+    r, w = os.pipe()
+    args = ["perf", "stat", "-x;", "--log-fd", str(w), "-r", str(repeat)]
+    for group in groups:
+        events = []
+        for counter in group:
+            name = "%s__%d" % (re.sub(r"\W", "_", counter), len(names))
+            event = _rename_event(raw[counter], name)
+            if event is None:
+                # Not a pmu/terms/ event, so we can't name it. Pass
+                # it through and match it by position.
+                event, name = raw[counter], None
+            names.append(name)
+            events.append(event)
+        args.extend(["-e", "{%s}" % ",".join(events)])
+    args.append("--")
+    args.extend(cmd)
+    perf = subprocess.Popen(args, pass_fds=[w])
+    os.close(w)
+
+    # Parse output as perf writes it.
+    rows = []
+    with os.fdopen(r, newline="") as rf:
+        for row in csv.reader(rf, delimiter=";"):
+            if not row or row[0].startswith("#"):
+                continue
+
+            # Column 1 is the count, which perf has already scaled by
+            # time_enabled/time_running. Column 2 is the unit (empty
+            # for plain counts). Column 3 is name. Column 4 is run time
+            # of the counter. Column 5 is percentage of time counter
+            # was running.
+            if row[0].startswith("<"):
+                # "<not counted>" or "<not supported>". This happens
+                # if the counter's group never got scheduled.
+                warn(cmd, "%s %s; treating as 0" % (row[2], row[0][1:-1]))
+                rows.append((row[2], 0))
+                continue
+            rows.append((row[2], int(row[0])))
+    res = perf.wait()
+    if res:
+        sys.exit(res)
+
+    byName = dict(rows)
+    if all(name in byName for name in names if name is not None):
+        # Unnamed counters get the rows we didn't name, in order.
+        ours = set(names)
+        rest = iter([count for name, count in rows if name not in ours])
+        return [byName[name] if name is not None else next(rest, 0)
+                for name in names]
+    # perf didn't report our names. Fall back to matching by order.
+    return [count for _, count in rows]
+
+def _rename_event(event, name):
+    # Return the perf event string event with its name= term replaced
+    # by name, or None if event isn't of the form pmu/terms/[modifiers].
+    m = re.fullmatch(r"([^/]+)/([^/]*)/(\w*)", event)
+    if m is None:
+        return None
+    terms = [t for t in m.group(2).split(",")
+             if t and not t.startswith("name=")]
+    terms.append("name=" + name)
+    return "%s/%s/%s" % (m.group(1), ",".join(terms), m.group(3))
+
+# perf_event_open ABI constants from linux/perf_event.h.
+_SYS_perf_event_open = {"x86_64": 298, "i386": 336, "i686": 336}
+_PERF_FORMAT_TOTAL_TIME_ENABLED = 1 << 0
+_PERF_FORMAT_TOTAL_TIME_RUNNING = 1 << 1
+_PERF_ATTR_DISABLED = 1 << 0
+_PERF_ATTR_INHERIT = 1 << 1
+_PERF_ATTR_EXCLUDE_KERNEL = 1 << 5
+_PERF_ATTR_EXCLUDE_HV = 1 << 6
+_PERF_ATTR_ENABLE_ON_EXEC = 1 << 12
+_PERF_FLAG_FD_CLOEXEC = 1 << 3
+# PERF_ATTR_SIZE_VER1: type, size, config, sample_period,
+# sample_type, read_format, flags, wakeup_events, bp_type, config1,
+# config2.
+_PERF_ATTR = struct.Struct("IIQQQQQIIQQ")
+
+_libc = None
+
+def _perf_event_open(type, config, pid, group_fd, flags):
+    global _libc
+    nr = _SYS_perf_event_open.get(platform.machine())
+    if nr is None:
+        raise OSError(errno.ENOSYS, "perf_event_open not supported on %s" %
+                      platform.machine())
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.syscall.restype = ctypes.c_long
+    # Read each counter separately rather than with
+    # PERF_FORMAT_GROUP. The kernel rejects PERF_FORMAT_GROUP on
+    # inherited counters, and we need inherit to count the
+    # command's threads and children.
+    read_format = _PERF_FORMAT_TOTAL_TIME_ENABLED | _PERF_FORMAT_TOTAL_TIME_RUNNING
+    attr = ctypes.create_string_buffer(_PERF_ATTR.pack(
+        type, _PERF_ATTR.size, config[0], 0, 0, read_format, flags,
+        0, 0, config[1], config[2]))
+    fd = _libc.syscall(ctypes.c_long(nr), attr, ctypes.c_int(pid),
+                       ctypes.c_int(-1), ctypes.c_int(group_fd),
+                       ctypes.c_ulong(_PERF_FLAG_FD_CLOEXEC))
+    if fd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return fd
+
+_CONFIG_FIELDS = {"config": 0, "config1": 1, "config2": 2}
+
+def _parse_raw(raw):
+    """Parse a raw perf event string like
+    "cpu/event=0x3c,umask=0x00,name=X/" into the PMU type and
+    [config, config1, config2] using the PMU's format description in
+    sysfs, the same way perf does."""
+    m = re.fullmatch(r"([^/]+)/(.*)/", raw)
+    if m is None:
+        raise OSError(errno.EINVAL, "can't parse event %r" % raw)
+    pmu = os.path.join("/sys/bus/event_source/devices", m.group(1))
+    with open(os.path.join(pmu, "type")) as f:
+        type = int(f.read())
+    config = [0, 0, 0]
+    for term in m.group(2).split(","):
+        key, eq, val = term.partition("=")
+        if key in ("name", "period", "freq"):
+            # These don't affect what's counted.
+            continue
+        val = int(val, 0) if eq else 1
+        if key in _CONFIG_FIELDS:
+            config[_CONFIG_FIELDS[key]] = val
+            continue
+        # Formats look like "config:0-7" or "config1:0-7,32-35".
+        with open(os.path.join(pmu, "format", key)) as f:
+            field, bits = f.read().strip().split(":")
+        i = _CONFIG_FIELDS[field]
+        for r in bits.split(","):
+            lo, _, hi = r.partition("-")
+            lo, hi = int(lo), int(hi or lo)
+            width = hi - lo + 1
+            config[i] |= (val & ((1 << width) - 1)) << lo
+            val >>= width
+    return type, config
+
+def _open_groups(events, pid, exclude):
+    # Open a counter group on pid for each list of (type, config) in
+    # events and return the counter fds, in order. exclude is
+    # additional attr flags for every counter.
+    fds = []
+    try:
+        for group in events:
+            leader = -1
+            for type, config in group:
+                flags = _PERF_ATTR_INHERIT | _PERF_ATTR_ENABLE_ON_EXEC | exclude
+                if leader == -1:
+                    flags |= _PERF_ATTR_DISABLED
+                fd = _perf_event_open(type, config, pid, leader, flags)
+                fds.append(fd)
+                if leader == -1:
+                    leader = fd
+    except OSError:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return fds
+
+def _count_perf_event_open(groups, cmd, repeat):
+    # Run cmd with the events in groups counted directly using
+    # perf_event_open and return their counts, in order.
+    events = [[_parse_raw(raw) for raw in group] for group in groups]
+    raws = [raw for group in groups for raw in group]
+    # Each counter's total and the number of runs it counted in.
+    total = [0] * sum(len(group) for group in groups)
+    runs = [0] * len(total)
+    exclude = 0
+    for _ in range(repeat):
+        # Start cmd, but hold it before exec until the counters are
+        # attached. The counters are enabled by its exec.
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(w)
+                os.read(r, 1)
+                os.execvp(cmd[0], cmd)
+            except OSError as e:
+                print("%s: %s" % (cmd[0], e), file=sys.stderr)
+            os._exit(127)
+        os.close(r)
+
+        fds = []
+        try:
+            try:
+                try:
+                    fds = _open_groups(events, pid, exclude)
+                except OSError as e:
+                    if exclude or e.errno not in (errno.EACCES, errno.EPERM):
+                        raise
+                    # With perf_event_paranoid >= 2 (the default since
+                    # Linux 4.6), unprivileged users can't count kernel
+                    # time. Do what perf does and count only user time.
+                    warn(cmd, "%s; counting user space only" % e)
+                    exclude = _PERF_ATTR_EXCLUDE_KERNEL | _PERF_ATTR_EXCLUDE_HV
+                    fds = _open_groups(events, pid, exclude)
+            except OSError:
+                os.kill(pid, signal.SIGKILL)
+                os.close(w)
+                os.waitpid(pid, 0)
+                raise
+
+            os.close(w)
+            _, status = os.waitpid(pid, 0)
+            res = os.waitstatus_to_exitcode(status)
+            if res:
+                sys.exit(res if res > 0 else 128 - res)
+            for i, fd in enumerate(fds):
+                value, enabled, running = struct.unpack("QQQ", os.read(fd, 24))
+                # Scale for the time the counter was multiplexed out.
+                if running != 0:
+                    total[i] += value * enabled / running
+                    runs[i] += 1
+        finally:
+            # Close the counters however we leave, including when cmd
+            # fails and we exit.
+            for fd in fds:
+                os.close(fd)
+
+    # Average each counter over only the runs it counted in, so runs
+    # where its group was never scheduled don't bias it toward 0.
+    for raw, n in zip(raws, runs):
+        if n == 0:
+            warn(cmd, "%s not counted; treating as 0" % raw)
+        elif n < repeat:
+            warn(cmd, "%s counted in only %d of %d runs" % (raw, n, repeat))
+    return [t / n if n else 0 for t, n in zip(total, runs)]
+
+def translate(events):
+    """Return a map from each ocperf event name in events to the
+    equivalent raw perf event string.
+
+    Events are looked up in the built-in Ivy Bridge table. There's no
+    fallback to ocperf.py: the scripts only run on the models in that
+    table, so new events should be added to _ivb_events.EVENTS.
+    """
+    raw = {}
+    for ev in events:
+        r = _ivb_events.lookup(ev)
+        if r is None:
+            print("unknown event %s" % ev, file=sys.stderr)
+            sys.exit(1)
+        raw[ev] = r
+    return raw
+
+def group_size():
+    """Return how many events to put in each event group alongside
+    the clock anchor.
+
+    Ivy Bridge has four general-purpose counters per thread with HT
+    on. The anchor normally goes on fixed counter 1, but when the NMI
+    watchdog is enabled its pinned cycles event holds that counter,
+    so the anchor needs a general-purpose counter too. A group that
+    needs more counters than exist can never be scheduled.
+    """
+    try:
+        with open("/proc/sys/kernel/nmi_watchdog") as f:
+            if f.read().strip() == "1":
+                return 3
+    except OSError:
+        pass
+    return 4
+
+_CPUINFO_RE = re.compile(rb"cpu family\s*:\s*(\d+).*?\nmodel\s*:\s*(\d+)", re.S)
+
+def cpu_family_model():
+    # The first processor's family and model are near the top of
+    # /proc/cpuinfo, so there's no need to read the whole thing
+    # (which is large on machines with many cores).
+    with open("/proc/cpuinfo", "rb") as f:
+        m = _CPUINFO_RE.search(f.read(4096))
+    if m is None:
+        print("failed to get CPU family and model from /proc/cpuinfo",
+              file=sys.stderr)
+        sys.exit(1)
+    return int(m.group(1)), int(m.group(2))
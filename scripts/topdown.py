@@ -1,108 +1,204 @@
 #!/usr/bin/python3
 
-import os
 import sys
-import subprocess
-import operator
-
-# TODO: Improve the quality of computed metrics using event groups.
-
-def gather(counters):
-    counters = list(frozenset(counters))
-    r, w = os.pipe()
-    args = ["ocperf.py", "stat", "-x;", "--log-fd", str(w)]
-    for counter in counters:
-        args.extend(["-e", counter])
-    args.extend(sys.argv[1:])
-    perf = subprocess.Popen(args, pass_fds=[w])
-    os.close(w)
-    r = os.fdopen(r)
-    output = r.read()
-    r.close()
-    res = perf.wait()
-    if res:
-        sys.exit(res)
-
-    #print(output, file=sys.stderr) # Debugging
-
-    # Parse output. Annoyingly, column 3 is the names, but ocperf
-    # generated names trim off modifiers, so we can't distinguish
-    # cmasks and such. Hence, we just match them up by order.
-    cmap = {}
-    for line in output.splitlines():
-        line = line.split("#", 1)[0].strip()
-        if not line:
-            continue
-        row = line.split(";")
-
-        # TODO: What's column 2? Column 3 is name. Column 4 is run
-        # time of the counter. Column 5 is fraction of time counter
-        # was running.
-        cmap[counters[len(cmap)]] = int(row[0])
-
-    return cmap
+import json
+import math
+import functools
+
+import _ivb_events
+from _perfcommon import arg_parser, parse_args, gather, sweep, group_size, cpu_family_model
 
 class Formula:
     def __init__(self, children):
         self.children = children
+        self._inv = None
 
-    def eval(self, ctx):
-        raise NotImplementedError("eval is abstract")
+    def _src(self, c):
+        """Return a Python expression computing this formula. c is
+        the _Compiler generating the expression; subexpressions must
+        be generated using c.expr."""
+        raise NotImplementedError("_src is abstract")
 
     def events(self):
-        raise NotImplementedError("events is abstract")
+        """Return the set of events this formula depends on."""
+        events = set()
+        for child in self.children:
+            events |= child.events()
+        return events
 
     def __add__(self, o):
-        return FormulaOp(operator.add, self, o)
+        return _Add(self, _const(o))
 
     def __radd__(self, o):
-        return FormulaOp(operator.add, o, self)
+        return _Add(_const(o), self)
 
     def __sub__(self, o):
-        return FormulaOp(operator.sub, self, o)
+        return _Sub(self, _const(o))
 
     def __rsub__(self, o):
-        return FormulaOp(operator.sub, o, self)
+        return _Sub(_const(o), self)
 
     def __mul__(self, o):
-        return FormulaOp(operator.mul, self, o)
+        if isinstance(o, (int, float)):
+            return _scale(o, self)
+        return _Mul(self, _const(o))
 
     def __rmul__(self, o):
-        return FormulaOp(operator.mul, o, self)
+        if isinstance(o, (int, float)):
+            return _scale(o, self)
+        return _Mul(_const(o), self)
 
     def __truediv__(self, o):
-        return FormulaOp(operator.truediv, self, o)
+        if isinstance(o, Formula):
+            # Nearly every ratio in the tree is over clocks or slots.
+            # Multiplying by a shared reciprocal means each
+            # denominator is only divided once per evaluation.
+            return _Mul(self, o._recip())
+        return _Div(self, _const(o))
 
     def __rtruediv__(self, o):
-        return FormulaOp(operator.truediv, o, self)
-
-class FormulaOp(Formula):
-    def __init__(self, op, *args):
-        super().__init__(args)
-        self.op = op
-
-    def eval(self, ctx):
-        args = [c.eval(ctx) if isinstance(c, Formula) else c
-                for c in self.children]
-        return self.op(*args)
-
-    def events(self):
-        events = []
-        for child in self.children:
-            if isinstance(child, Formula):
-                events.extend(child.events())
-        return events
+        return _scale(o, self._recip())
+
+    def _recip(self):
+        """Return the formula 1/self. This is the same object every
+        time, so _Compiler computes it once however many ratios use
+        it."""
+        if self._inv is None:
+            self._inv = _Recip(self)
+        return self._inv
+
+def _const(x):
+    if isinstance(x, Formula):
+        return x
+    return _Const(x)
+
+class _Const(Formula):
+    def __init__(self, value):
+        super().__init__(())
+        self.value = value
+
+    def _src(self, c):
+        return repr(self.value)
+
+def _scale(k, x):
+    # Fold nested constant factors into one.
+    if isinstance(x, _Scale):
+        return _Scale(k * x.k, x.x)
+    return _Scale(k, x)
+
+class _Scale(Formula):
+    def __init__(self, k, x):
+        super().__init__((x,))
+        self.k, self.x = k, x
+
+    def _src(self, c):
+        return "(%r * %s)" % (self.k, c.expr(self.x))
+
+    def _recip(self):
+        # 1/(k*x) = (1/k) * (1/x), which shares 1/x with other ratios
+        # over x. In particular, slots shares clocks' reciprocal.
+        if self._inv is None:
+            self._inv = _scale(1 / self.k, self.x._recip())
+        return self._inv
+
+class _Recip(Formula):
+    def __init__(self, x):
+        super().__init__((x,))
+        self.x = x
+
+    def _src(self, c):
+        return "_div(1, %s)" % c.expr(self.x)
+
+class _BinOp(Formula):
+    def __init__(self, a, b):
+        super().__init__((a, b))
+        self.a, self.b = a, b
+
+class _Add(_BinOp):
+    def _src(self, c):
+        return "(%s + %s)" % (c.expr(self.a), c.expr(self.b))
+
+class _Sub(_BinOp):
+    def _src(self, c):
+        return "(%s - %s)" % (c.expr(self.a), c.expr(self.b))
+
+class _Mul(_BinOp):
+    def _src(self, c):
+        return "(%s * %s)" % (c.expr(self.a), c.expr(self.b))
+
+class _Div(_BinOp):
+    def _src(self, c):
+        return "_div(%s, %s)" % (c.expr(self.a), c.expr(self.b))
+
+class Min(_BinOp):
+    def __init__(self, a, b):
+        super().__init__(_const(a), _const(b))
+
+    def _src(self, c):
+        return "min(%s, %s)" % (c.expr(self.a), c.expr(self.b))
 
 class E(Formula):
     def __init__(self, event):
-        super().__init__([])
+        super().__init__(())
         self.event = event
 
-    def eval(self, ctx):
-        return ctx[self.event]
-
     def events(self):
-        return [self.event]
+        return {self.event}
+
+    def _src(self, c):
+        return "ctx[%r]" % self.event
+
+def _div(a, b):
+    # gather reports events that were never counted as 0. Make
+    # ratios over them NaN rather than failing the whole tree.
+    if b == 0:
+        return math.nan
+    return a / b
+
+class _Compiler:
+    """_Compiler generates a single Python function that evaluates a
+    list of formulas. Subformulas that are used more than once are
+    computed once and bound to a local."""
+
+    def __init__(self, formulas):
+        self.formulas = formulas
+        self.refs = {}
+        self.names = {}
+        for f in formulas:
+            self._count(f)
+
+    def _key(self, f):
+        # Separate E objects for the same event are the same
+        # subexpression.
+        if isinstance(f, E):
+            return f.event
+        return id(f)
+
+    def _count(self, f):
+        k = self._key(f)
+        self.refs[k] = self.refs.get(k, 0) + 1
+        if self.refs[k] == 1:
+            for child in f.children:
+                self._count(child)
+
+    def expr(self, f):
+        k = self._key(f)
+        if k in self.names:
+            return self.names[k]
+        src = f._src(self)
+        if self.refs[k] > 1 and not isinstance(f, _Const):
+            # Python evaluates operands left to right, so the first
+            # occurrence in the source is also the first evaluated.
+            name = self.names[k] = "_t%d" % len(self.names)
+            src = "(%s := %s)" % (name, src)
+        return src
+
+    def compile(self):
+        """Return a function that takes event counts ctx and returns
+        a tuple of the values of self.formulas."""
+        src = "lambda ctx: (%s,)" % ", ".join(self.expr(f) for f in self.formulas)
+        return eval(compile(src, "<topdown>", "eval"),
+                    {"min": min, "_div": _div})
 
 # Top-Down bottleneck formulas. These are mostly from Yasin 2014, "A
 # Top-Down Method for Performance Analysis and Counters Architecture"
@@ -139,7 +235,7 @@ l1_DTLBMiss = (l1_STLBHitCost * E("DTLB_LOAD_MISSES.STLB_HIT") + E("DTLB_LOAD_MI
 l1_SFBCost = 13
 l1_StoreForwardBlocked = l1_SFBCost * E("LD_BLOCKS.STORE_FORWARD") / clocks
 l1_LockStoreFraction = E("MEM_UOPS_RETIRED.LOCK_LOADS") / E("MEM_UOPS_RETIRED.ALL_STORES")
-oroDemandRFOC1 = FormulaOp(min, E("CPU_CLK_UNHALTED.THREAD"), E("OFFCORE_REQUESTS_OUTSTANDING.CYCLES_WITH_DEMAND_RFO"))
+oroDemandRFOC1 = Min(E("CPU_CLK_UNHALTED.THREAD"), E("OFFCORE_REQUESTS_OUTSTANDING.CYCLES_WITH_DEMAND_RFO"))
 l1_LockLatency = l1_LockStoreFraction * oroDemandRFOC1 / clocks
 # Load spans two cache lines.
 l1_SplitLoads = 13 * E("LD_BLOCKS.NO_SR") / clocks
@@ -167,25 +263,78 @@ extMem_LatencyBound = (E("OFFCORE_REQUESTS_OUTSTANDING.CYCLES_WITH_DEMAND_DATA_R
 class Node:
     def __init__(self, label, value, *children):
         self.label, self.value, self.children = label, value, children
+        self._formula = self._fn = None
 
     def events(self):
-        counters = []
+        counters = set()
         if self.value is not None:
-            counters.extend(self.value.events())
+            counters |= self.value.events()
         for child in self.children:
-            counters.extend(child.events())
+            counters |= child.events()
         return counters
 
-    def eval(self, ctx):
-        if self.value is None:
-            return sum(child.eval(ctx) for child in self.children)
-        return self.value.eval(ctx)
+    def walk(self):
+        """Yield the nodes of this tree in pre-order."""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def formula(self):
+        """Return the formula for this node's value. If the node has
+        no value formula of its own, this is the sum of its children's
+        formulas."""
+        if self._formula is None:
+            if self.value is not None:
+                self._formula = self.value
+            else:
+                for child in self.children:
+                    f = child.formula()
+                    self._formula = f if self._formula is None else self._formula + f
+        return self._formula
+
+    def compile(self):
+        """Return a function that takes event counts ctx and returns
+        the values of all nodes in this tree, in pre-order. The
+        function is generated once and reused."""
+        if self._fn is None:
+            formulas = [node.formula() for node in self.walk()]
+            self._fn = _Compiler(formulas).compile()
+        return self._fn
 
-    def show(self, ctx, indent=0):
-        value = self.eval(ctx)
-        print("%-30s %6.2f%%" % ("  " * indent + self.label, 100*value))
+    def eval(self, ctx):
+        return self.compile()(ctx)[0]
+
+    def show(self, ctx):
+        sys.stdout.write(self.format(ctx))
+
+    def format(self, ctx):
+        """Return the text that show prints."""
+        lines = []
+        self._collect(iter(self.compile()(ctx)), 0, lines)
+        return "\n".join(lines) + "\n"
+
+    def _collect(self, values, indent, out):
+        value = next(values)
+        label = "  " * indent + self.label
+        if math.isnan(value):
+            out.append("%-30s %7s" % (label, "n/a"))
+        else:
+            out.append("%-30s %6.2f%%" % (label, 100*value))
         for child in self.children:
-            child.show(ctx, indent+1)
+            child._collect(values, indent+1, out)
+
+    def to_dict(self, ctx):
+        """Return the values of this tree as nested dicts with keys
+        "label", "value", and "children". value is None if it couldn't
+        be computed."""
+        return self._to_dict(iter(self.compile()(ctx)))
+
+    def _to_dict(self, values):
+        value = next(values)
+        if math.isnan(value):
+            value = None
+        return {"label": self.label, "value": value,
+                "children": [child._to_dict(values) for child in self.children]}
 
 tree = Node("All slots", None,
             Node("µop issued", None,
@@ -214,30 +363,54 @@ tree = Node("All slots", None,
                                 Node("Bandwidth *", extMem_BandwidthBound),
                                 Node("Latency *", extMem_LatencyBound))))))
 
-def cpu_family_model():
-    family = model = None
-    for l in open("/proc/cpuinfo").readlines():
-        if l.startswith("cpu family\t"):
-            family = int(l.split(":")[1])
-        if l.startswith("model\t"):
-            model = int(l.split(":")[1])
-        if family != None and model != None:
-            return family, model
-    print("failed to get CPU family and model from /proc/cpuinfo",
-          file=sys.stderr)
-    sys.exit(1)
+def partition(eventsets, anchor, size):
+    """Partition the events in eventsets into event groups.
+
+    Each group has at most size events plus anchor, which is added to
+    every group. Events from the same set are kept in the same group
+    where they fit, so a formula over them is computed from a single
+    measurement window.
+    """
+    groups, group, seen = [], [], {anchor}
+    for events in eventsets:
+        events = [ev for ev in sorted(events) if ev not in seen]
+        seen.update(events)
+        if len(group) + len(events) > size:
+            groups.append(group)
+            group = []
+        for ev in events:
+            if len(group) == size:
+                groups.append(group)
+                group = []
+            group.append(ev)
+    if group:
+        groups.append(group)
+    return [[anchor] + group for group in groups if group]
+
+def measure(args, cmd):
+    # The clock goes in every group as the anchor (see group_size).
+    eventsets = [node.value.events() for node in tree.walk()
+                 if node.value is not None]
+    groups = partition(eventsets, clocks.event, group_size())
+    ctx = gather(groups, cmd, clocks.event, args.repeat)
+    if args.json:
+        return json.dumps(tree.to_dict(ctx), indent=2, ensure_ascii=False) + "\n"
+    return tree.format(ctx)
 
 def main():
+    parser = arg_parser("Measure the Top-Down bottleneck breakdown of a command.")
+    parser.add_argument("--json", action="store_true",
+                        help="print the tree as JSON")
+    args = parse_args(parser)
+
     # Only Ivy Bridge for now.
     family, model = cpu_family_model()
-    if (family, model) not in [(0x06, 0x3a), (0x06, 0x3e)]:
+    if (family, model) not in _ivb_events.MODELS:
         print("unsupported CPU model %02x_%02xH" % (family, model),
               file=sys.stderr)
         sys.exit(1)
 
-    events = tree.events()
-    ctx = gather(events)
-    tree.show(ctx)
+    sweep(functools.partial(measure, args), args)
 
 if __name__ == "__main__":
     main()